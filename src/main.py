@@ -9,47 +9,119 @@ import logging
 import os
 import platform
 import pprint
-import subprocess
+import signal
+import sqlite3
 import sys
 import warnings
-from threading import Thread
-from multiprocessing import Process
+from collections import OrderedDict, deque
 from random import randint as semi_random_int
 from time import time as time_timestamp
 from traceback import format_exc as get_traceback_str
-from typing import Any, Awaitable, Dict, List, Optional
+from typing import Any, Awaitable, Callable, Deque, Dict, FrozenSet, Iterable, List, Optional, Tuple
 
 import discord  # type: ignore
 import psutil  # type: ignore
 import sqlalchemy  # type: ignore
 import sqlalchemy_utils  # type: ignore
+from aiohttp import web
 from distro import name as get_distro_name
-from flask import Flask
 from sqlalchemy.ext.declarative import declarative_base  # type: ignore
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 CONFIG: Dict[str, Any] = {
     "prefix": "'",
     "note-prefix": '"',
     "hello-message": "Hello world",
     "bye-message": "Goodbye world",
     "cache-sz": 500,
+    "cache-bytes": 4 * 1024 * 1024,
     "logging": True,
     "sh-timeout": 10,
     "chunk-limit": 4,
     "playing": "",
 }
 CONFIG_PATH: str = "config.json"
-GLOBAL_STATE: Dict[str, Any] = {"exit": 0}
+GLOBAL_STATE: Dict[str, Any] = {
+    "exit": 0,
+    "prefixes": (CONFIG["prefix"], CONFIG["note-prefix"]),
+}
+
+
+def sizeof(obj: Any) -> int:
+    if isinstance(obj, str):
+        return len(obj.encode())
+
+    if isinstance(obj, (list, tuple)):
+        return sum(map(sizeof, obj))
+
+    return sys.getsizeof(obj)
+
+
+class LRUCache(OrderedDict):
+    """A least-recently-used cache bound by the `cache-sz` and
+    `cache-bytes` config keys"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._bytes: int = 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        if key not in self:
+            return default
 
-CACHE: Dict[str, Any] = {
-    "s2c": {},
-    "c2s": {},
+        self.move_to_end(key)
+        return self[key]
+
+    def put(self, key: Any, value: Any) -> None:
+        if key in self:
+            self._bytes -= sizeof(key) + sizeof(self[key])
+
+        self[key] = value
+        self.move_to_end(key)
+        self._bytes += sizeof(key) + sizeof(value)
+
+        while self and (
+            len(self) > CONFIG["cache-sz"] or self._bytes > CONFIG["cache-bytes"]
+        ):
+            old_key, old_value = self.popitem(last=False)
+            self._bytes -= sizeof(old_key) + sizeof(old_value)
+
+
+CACHE: Dict[str, LRUCache] = {
+    "s2c": LRUCache(),
 }
-PFORMAT_CACHE: Dict[str, str] = {}
+PFORMAT_CACHE: LRUCache = LRUCache()
+PRETTY_PRINTER: pprint.PrettyPrinter = pprint.PrettyPrinter(depth=6, width=100, compact=True)
+NOTE_CACHE: Dict[str, str] = {}
 
-DB_ENGINE: sqlalchemy.engine.base.Engine = sqlalchemy.create_engine("sqlite:///bot.db")
+DB_PATH: str = "bot.db"
+DB_ENGINE: sqlalchemy.engine.base.Engine = sqlalchemy.create_engine(f"sqlite:///{DB_PATH}")
 DB_BASE: sqlalchemy.orm.decl_api.DeclarativeMeta = declarative_base()
-DB_SESSION = sqlalchemy.orm.Session(DB_ENGINE)
+DB_SESSION = sqlalchemy.orm.Session(DB_ENGINE)  # Only for raw `sql` queries
+
+
+@sqlalchemy.event.listens_for(DB_ENGINE, "connect")
+def set_db_pragmas(db_conn: sqlite3.Connection, _: Any = None) -> None:
+    cursor: sqlite3.Cursor = db_conn.cursor()
+
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA mmap_size=67108864")
+    cursor.execute("PRAGMA cache_size=-8000")
+
+    cursor.close()
+
+
+DB_CONN: sqlite3.Connection  # Opened in main(), once the schema exists
+
+SQL_SELECT_NOTES: str = "SELECT name, content FROM notes"
+SQL_SELECT_NOTE_NAMES: str = "SELECT name FROM notes"
+SQL_INSERT_NOTE: str = "INSERT INTO notes (name, content) VALUES (?, ?)"
+SQL_DELETE_NOTE: str = "DELETE FROM notes WHERE name = ?"
 
 
 class Note(DB_BASE):  # type: ignore
@@ -63,66 +135,94 @@ class Note(DB_BASE):  # type: ignore
         self.content = content
 
 
+def load_notes() -> None:
+    log("Loading notes")
+
+    NOTE_CACHE.clear()
+    NOTE_CACHE.update(DB_CONN.execute(SQL_SELECT_NOTES).fetchall())
+
+
+def json_dumps(obj: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+    return json.dumps(obj, indent=2)
+
+
+def json_loads(data: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+
 def dump_config() -> None:
     log("Dumping config")
 
-    with open(CONFIG_PATH, "w") as cfg:
-        json.dump(CONFIG, cfg, indent=4)
+    # Write a temporary file and swap it in so the config is never torn
+    with open(f"{CONFIG_PATH}.tmp", "w", encoding="utf-8") as cfg:
+        cfg.write(json_dumps(CONFIG))
+
+    os.replace(f"{CONFIG_PATH}.tmp", CONFIG_PATH)
 
 
-def log(message: str) -> None:
+def log(message: str, *args: Any) -> None:
     if not CONFIG["logging"]:
         return
 
-    print(f" :: {message}")
+    print(f" :: {message % args if args else message}")
 
 
 def pformat_cached(string: Any) -> str:
     _string: str = f"{type(string)}.{string}"
 
-    if len(PFORMAT_CACHE) > CONFIG["cache-sz"]:
-        PFORMAT_CACHE.clear()
-    elif _string in PFORMAT_CACHE:
-        return PFORMAT_CACHE[_string]
+    if (cached := PFORMAT_CACHE.get(_string)) is not None:
+        return cached
 
-    result: str = pprint.pformat(string)
+    result: str = PRETTY_PRINTER.pformat(string)
 
-    PFORMAT_CACHE[_string] = result
+    PFORMAT_CACHE.put(_string, result)
     return result
 
 
-def command_to_str(command: List[List[str]]) -> str:
-    _repr: str = repr(command)
+class Command:
+    """A command string with its non-empty words, consumed from the left"""
 
-    if len(CACHE["c2s"]) > CONFIG["cache-sz"]:
-        CACHE["c2s"].clear()
-    elif _repr in CACHE["c2s"]:
-        return CACHE["c2s"][_repr]
+    def __init__(self, original: str, words: Iterable[str]) -> None:
+        self.original: str = original
+        self.words: Deque[str] = deque(words)
+        self.offset: int = 0
 
-    result: str = "".join(f"{' '.join(line)}\n" for line in command).strip()
+    def __bool__(self) -> bool:
+        return bool(self.words)
 
-    CACHE["c2s"][_repr] = result
-    return result
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.original[self.offset:]!r}, {list(self.words)!r})"
 
 
-def str_to_command(command: str) -> List[List[str]]:
-    if len(CACHE["s2c"]) > CONFIG["cache-sz"]:
-        CACHE["s2c"].clear()
-    elif command in CACHE["s2c"]:
-        return json.loads(CACHE["s2c"][command])
+def command_to_str(command: Command) -> str:
+    return command.original[command.offset :].strip()
 
-    result: List[List[str]] = [line.split(" ") for line in command.strip().split("\n")]
 
-    CACHE["s2c"][command] = json.dumps(result)
+def str_to_command(command: str) -> Command:
+    original: str = command.strip()
+    words: Optional[Tuple[str, ...]] = CACHE["s2c"].get(original)
 
-    return result
+    if words is None:
+        words = tuple(
+            word for line in original.split("\n") for word in line.split(" ") if word
+        )
+        CACHE["s2c"].put(original, words)
+
+    return Command(original, words)
 
 
 def m(content: str, message: discord.Message) -> str:
     return f"<@{message.author.id}> {content}"
 
 
-def uncode(string: str, codedel: str = "`") -> str:
+def uncode(string: str, codedel: str = "```") -> str:
+    # Backslashes show up literally in code, so only break up code fences
     return string.replace(codedel, "\\".join(codedel))
 
 
@@ -141,19 +241,56 @@ def async_exit(msg: Optional[str] = None, code: int = 1) -> None:
             sys.exit()
 
 
-def get_nth_word(command: List[List[str]], n: int = 0) -> Optional[str]:
-    found: int = 0
+def get_nth_word(command: Command) -> Optional[str]:
+    if not command.words:
+        return None
 
-    for widx, word in enumerate(command):
-        if command and all(command):
-            found += 1
+    word: str = command.words.popleft()
+    command.offset = command.original.index(word, command.offset) + len(word)
+    return word
 
-        if (found - 1) == n:
-            result: str = word[0]
-            del command[widx][0]
-            return result
 
-    return None
+def make_botfetch_head() -> str:
+    uname = os.uname()
+    header: str = f"{psutil.Process().username()}@{uname.nodename}"
+
+    return uncode(
+        f"""
+     <----->         {header}
+    <  (0)  >        {'-' * len(header)}
+    |       |        OS: {get_distro_name()}
+   < ------- >           - Type: {sys.platform}
+   o         o           - Release: {platform.release()}
+   o  0  ()  o               - Version: {platform.version()}
+  o           o      Kernel: {uname.sysname} {uname.release}
+o o o o o o o o o        - Architecture: {uname.machine}
+o o o o o o o o o    Shell: {os.environ.get("SHELL") or '/bin/sh'}
+o o o o o o o o o    CPU: {platform.processor()} ["""
+    )
+
+
+# None of these change while the bot is running
+BOTFETCH_HEAD: str = make_botfetch_head()
+BOOT_TIME: float = psutil.boot_time()
+
+COMMANDS: Dict[str, Tuple[Callable[..., Awaitable[None]], str, Optional[str]]] = {}
+
+
+def bot_command(
+    handler: Callable[..., Awaitable[None]]
+) -> Callable[..., Awaitable[None]]:
+    """Register a `cmd_*` handler along with its rendered help"""
+
+    doc: Optional[str] = handler.__doc__
+    summary: str = (doc or "").split("\n")[0] or "No help available"
+    help_text: Optional[str] = None
+
+    if doc is not None:
+        help_text = "\n".join(line.strip() for line in uncode(doc).split("\n"))
+        help_text = f"```\n{help_text}\n```"
+
+    COMMANDS[handler.__name__.removeprefix("cmd_")] = (handler, summary, help_text)
+    return handler
 
 
 class BotCommandsParser:
@@ -161,32 +298,28 @@ class BotCommandsParser:
         self.bot = bot
 
     async def _send_message(self, message: str) -> None:
-        for chunk_idx, chunk in enumerate(
+        chunks: List[str] = [
             message[i : i + 2000] for i in range(0, len(message), 2000)
-        ):
-            if chunk_idx > CONFIG["chunk-limit"]:
-                log("Too many chunks being sent, stopping")
-                await self.bot.cchannel.send(
-                    f"***Message chunk count exceeded ({CONFIG['chunk-limit']}), message too long!***"
-                )
-                return
+        ]
 
+        # Sent one by one, as that is the only way to keep chunks in order
+        for chunk in chunks[: CONFIG["chunk-limit"] + 1]:
             await self.bot.cchannel.send(f"{chunk}\n")
 
+        if len(chunks) > CONFIG["chunk-limit"] + 1:
+            log("Too many chunks being sent, stopping")
+            await self.bot.cchannel.send(
+                f"***Message chunk count exceeded ({CONFIG['chunk-limit']}), message too long!***"
+            )
+
     def _note_exists(self, note_name: str) -> bool:
-        return DB_SESSION.query(Note).filter_by(name=note_name).first() is not None
+        return note_name in NOTE_CACHE
 
     def _get_help(self, what: str) -> Optional[str]:
-        if (handler := getattr(self, f"cmd_{what}", None)) is None:
+        if (cmd := COMMANDS.get(what)) is None:
             return None
 
-        if handler.__doc__ is None:
-            return None
-
-        help_text: str = "\n".join(
-            line.strip() for line in uncode(handler.__doc__).split("\n")
-        )
-        return f"```\n{help_text}\n```"
+        return cmd[2]
 
     async def _send_help(self, what: str, message: discord.Message):
         text: str = f"No such command/help: {what!r}"
@@ -196,10 +329,11 @@ class BotCommandsParser:
 
         await self._send_message(m(f"\n{text}", message))
 
+    @bot_command
     async def cmd_say(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Repeat a specified string
         Usage: say <content...>"""
@@ -212,10 +346,11 @@ class BotCommandsParser:
 
         await self._send_message(say_content)
 
+    @bot_command
     async def cmd_set(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Set a note to a value (save it)
         Usage: set <name> <content...>"""
@@ -224,20 +359,26 @@ class BotCommandsParser:
             await self._send_help("set", message)
             return
 
+        content: str = command_to_str(command)
+
         try:
-            DB_SESSION.add(Note(name=note_name, content=command_to_str(command)))
-            DB_SESSION.commit()
-        except sqlalchemy.exc.IntegrityError:
-            DB_SESSION.rollback()
+            DB_CONN.execute(SQL_INSERT_NOTE, (note_name, content))
+        except sqlite3.IntegrityError:
             await self._send_message(m(f"Note {note_name!r} already exists", message))
             return
+        except sqlite3.OperationalError as err:
+            await self._send_message(m(f"Saving note {note_name!r} failed: {err!r}", message))
+            return
+
+        NOTE_CACHE[note_name] = content
 
         await self._send_message(m(f"Note {note_name!r} saved", message))
 
+    @bot_command
     async def cmd_del(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Delete a note
         Usage: del <name>"""
@@ -250,15 +391,21 @@ class BotCommandsParser:
             await self._send_message(m(f"Note {note_name!r} doesn't exist", message))
             return
 
-        DB_SESSION.execute(sqlalchemy.delete(Note).where(Note.name == note_name))
-        DB_SESSION.commit()
+        try:
+            DB_CONN.execute(SQL_DELETE_NOTE, (note_name,))
+        except sqlite3.OperationalError as err:
+            await self._send_message(m(f"Deleting note {note_name!r} failed: {err!r}", message))
+            return
+
+        NOTE_CACHE.pop(note_name, None)
 
         await self._send_message(m(f"Note {note_name!r} deleted", message))
 
+    @bot_command
     async def cmd_cya(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Make the bot end itself
         Usage: cya"""
@@ -266,17 +413,18 @@ class BotCommandsParser:
         await self._send_message(CONFIG["bye-message"])
         async_exit("Exiting bot because of the cya command", 0)
 
+    @bot_command
     async def cmd_list(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """List all notes
         Usage: list"""
 
         notes_list: str = (
             "\n".join(
-                f"**-** {''.join(ent)}" for ent in DB_SESSION.query(Note.name).all()
+                f"**-** {name}" for (name,) in DB_CONN.execute(SQL_SELECT_NOTE_NAMES)
             )
             or "*No notes found*"
         )
@@ -290,10 +438,11 @@ To invoke/expand a note, type '{CONFIG['note-prefix']}<note name>',
 for example: {CONFIG['note-prefix']}Hello"""
         )
 
+    @bot_command
     async def cmd_help(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Get help about a command
         Usage: help [command]"""
@@ -302,21 +451,13 @@ for example: {CONFIG['note-prefix']}Hello"""
             await self._send_help(cmd_name, message)
             return
 
-        _help: str = "\n"
-        _nl: str = "\n"
-
-        for attr in dir(self):
-            if not attr.startswith("cmd"):
-                continue
-
-            _help += f"`{uncode(attr[4:])}` -- {uncode(getattr(self, attr).__doc__.split(_nl)[0] or 'No help available')}\n"
-
-        await self._send_message(m(_help, message))
+        await self._send_message(m(HELP_INDEX, message))
 
+    @bot_command
     async def cmd_sql(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Run raw sql queries on the bot's database
         Usage: sql <sql query>"""
@@ -330,39 +471,50 @@ for example: {CONFIG['note-prefix']}Hello"""
         text: str
 
         try:
+            result = DB_SESSION.execute(sql_query)
+            results: str = (
+                "\n".join(", ".join(map(repr, row)) for row in result)
+                if result.returns_rows
+                else ""
+            ) or "# No rows"
             text = f"""
 Executed query `{uncode(sql_query)}`
 
 ```py
 # Query results
 
-{pformat_cached(DB_SESSION.execute(f'{sql_query}').all())}
+{results}
 ```
 """
             DB_SESSION.commit()
+            load_notes()  # Raw queries may have changed any note
         except Exception as err:
+            # Don't leave a transaction open, it would lock out note writes
+            DB_SESSION.rollback()
             text = f"Executing query failed: {err!r}"
 
         await self._send_message(m(text, message))
 
+    @bot_command
     async def cmd_config(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Get bot's config
         Usage: config"""
 
         await self._send_message(
-            m(f"\n```json\n{uncode(json.dumps(CONFIG, indent=4))}\n```", message)
+            m(f"\n```json\n{uncode(json_dumps(CONFIG))}\n```", message)
         )
 
+    @bot_command
     async def cmd_sh(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
-        """Run a **blocking** shell command
+        """Run a shell command
         Usage: sh <command...>"""
 
         sh_command: str = command_to_str(command)
@@ -373,20 +525,38 @@ Executed query `{uncode(sql_query)}`
 
         output: str
         try:
-            output = subprocess.check_output(
+            proc: asyncio.subprocess.Process = await asyncio.create_subprocess_shell(
                 sh_command,
-                shell=True,
-                timeout=CONFIG["sh-timeout"],
-                stderr=subprocess.STDOUT,
-            ).decode()
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True,
+            )
         except FileNotFoundError:
             output = "sh: Command not found"
-        except subprocess.CalledProcessError as err:
-            err.output = err.output or b"No output after a non-zero exit code"
-            output = f"Exit code: {err.returncode}\n\n{err.output.decode()}"
-        except subprocess.TimeoutExpired as err:
-            err.output = err.output or b"No output after a command timeout"
-            output = f"Command timedout\n\n{err.output.decode()}"
+        else:
+            stdout: bytearray = bytearray()
+
+            async def _read_output() -> None:
+                while chunk := await proc.stdout.read(4096):  # type: ignore
+                    stdout.extend(chunk)
+
+                await proc.wait()
+
+            try:
+                await asyncio.wait_for(_read_output(), timeout=CONFIG["sh-timeout"])
+                output = stdout.decode(errors="replace")
+
+                if proc.returncode:
+                    output = f"Exit code: {proc.returncode}\n\n{output or 'No output after a non-zero exit code'}"
+            except asyncio.TimeoutError:
+                # Kill the whole process group, children of the shell hold the pipe too
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+                await proc.wait()
+                output = f"Command timedout\n\n{stdout.decode(errors='replace') or 'No output after a command timeout'}"
 
         await self._send_message(
             m(
@@ -402,50 +572,42 @@ Output:
             )
         )
 
+    @bot_command
     async def cmd_botfetch(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Fetch server info
         Usage: botfetch"""
 
         ram = psutil.virtual_memory()
-        uname = os.uname()
-        cpu_usage: str = f"{psutil.cpu_percent()}%"
-        header: str = f"{psutil.Process().username()}@{uname.nodename}"
+        # Non-blocking, measures usage since the previous call (seeded in main())
+        cpu_per_core: List[float] = psutil.cpu_percent(percpu=True, interval=None)
+        cpu_usage: str = f"{sum(cpu_per_core) / len(cpu_per_core):.1f}%"
         cpu_list: str = ""
 
-        for core, usage in enumerate(psutil.cpu_percent(percpu=True, interval=1), 1):
+        for core, usage in enumerate(cpu_per_core, 1):
             cpu_list += f"{' ' * 25}- Core{core}: {usage}%\n"
 
-        fetch: str = f"""
-     <----->         {header}
-    <  (0)  >        {'-' * len(header)}
-    |       |        OS: {get_distro_name()}
-   < ------- >           - Type: {sys.platform}
-   o         o           - Release: {platform.release()}
-   o  0  ()  o               - Version: {platform.version()}
-  o           o      Kernel: {uname.sysname} {uname.release}
-o o o o o o o o o        - Architecture: {uname.machine}
-o o o o o o o o o    Shell: {os.environ.get("SHELL") or '/bin/sh'}
-o o o o o o o o o    CPU: {platform.processor()} [{cpu_usage}]
+        fetch: str = f"""{cpu_usage}]
 {cpu_list[:-1]}
                      Memory: {ram.used >> 20} / {ram.total >> 20} MB ({ram.percent}%)
-                     Uptime: {dt.timedelta(seconds=time_timestamp() - psutil.boot_time())}
+                     Uptime: {dt.timedelta(seconds=time_timestamp() - BOOT_TIME)}
 """
 
         await self._send_message(
             m(
-                f"```yml\n{uncode(fetch)}\n```",
+                f"```yml\n{BOTFETCH_HEAD}{uncode(fetch)}\n```",
                 message,
             )
         )
 
+    @bot_command
     async def cmd_sayd(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Repeat a specified string and then delete the original message
         Usage: sayd <content...>"""
@@ -457,30 +619,33 @@ o o o o o o o o o    CPU: {platform.processor()} [{cpu_usage}]
         await message.delete()
         await self._send_message(say)
 
+    @bot_command
     async def cmd_dumpcache(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Dump in-memory message cache
         Usage: dumpcache"""
 
         await self._send_message(f"```py\n{pformat_cached(CACHE)}\n```")
 
+    @bot_command
     async def cmd_dumpcachep(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Dump in-memory pformat cache
         Usage: dumpcachep"""
 
         await self._send_message(f"```py\n{pformat_cached(PFORMAT_CACHE)}\n```")
 
+    @bot_command
     async def cmd_status(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Change activity status
         Usage: status <status...>"""
@@ -490,15 +655,18 @@ o o o o o o o o o    CPU: {platform.processor()} [{cpu_usage}]
             return
 
         CONFIG["playing"] = status
-        Thread(target=dump_config).start()
+
+        if self.bot.config_dirty is not None:
+            self.bot.config_dirty.set()
 
         await self.bot._change_status()
         await self._send_message(f"Changed status to `{uncode(status)}`")
 
+    @bot_command
     async def cmd_warm(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Warm a user
         Usage: warm <user>"""
@@ -509,10 +677,11 @@ o o o o o o o o o    CPU: {platform.processor()} [{cpu_usage}]
 
         await self._send_message(f":tea::coffee::heart_on_fire: {warm} :heart_on_fire::coffee::tea:")
 
+    @bot_command
     async def cmd_banana(
         self,
         message: discord.Message,
-        command: List[List[str]],
+        command: Command,
     ) -> None:
         """Banana a user
         Usage: banana <user>"""
@@ -524,6 +693,13 @@ o o o o o o o o o    CPU: {platform.processor()} [{cpu_usage}]
         await self._send_message(f":banana: {banana} :banana:")
 
 
+# Commands are fixed at class definition, so the index is only rendered once
+HELP_INDEX: str = "\n" + "".join(
+    f"`{uncode(name)}` -- {uncode(summary)}\n"
+    for name, (_, summary, _) in sorted(COMMANDS.items())
+)
+
+
 class Bot(discord.Client):
     """The bot"""
 
@@ -535,6 +711,10 @@ class Bot(discord.Client):
 
         self.cchannel: Optional[discord.TextChannel] = None
         self.parser = BotCommandsParser(self)
+        self.ping_runner: Optional[web.AppRunner] = None
+        self.role_ids: Dict[int, FrozenSet[int]] = {}
+        self.config_dirty: Optional[asyncio.Event] = None  # Made in on_ready()
+        self.config_writer: Optional[asyncio.Task] = None
 
         log("Making the bot")
         super().__init__(intents=intents)
@@ -546,6 +726,78 @@ class Bot(discord.Client):
             activity=discord.Game(name=CONFIG["playing"])
         )
 
+    def _get_role_ids(self, guild: discord.Guild) -> FrozenSet[int]:
+        if (role_ids := self.role_ids.get(guild.id)) is None:
+            role_ids = self.role_ids[guild.id] = frozenset(
+                role.id
+                for role in guild.get_member(self.user.id).roles
+                if not role.name.startswith("@")
+            )
+
+        return role_ids
+
+    async def _start_ping_server(self) -> None:
+        log("Setting up the ping server")
+
+        async def _ping(_: web.Request) -> web.Response:
+            return web.Response(text="")
+
+        ping_app: web.Application = web.Application()
+        ping_app.router.add_get("/", _ping)
+
+        self.ping_runner = web.AppRunner(ping_app, access_log=None)
+        await self.ping_runner.setup()
+
+        _port: int = semi_random_int(2000, 9000)
+        log(f"Running ping server at port {_port!r}")
+
+        try:
+            await web.TCPSite(self.ping_runner, "0.0.0.0", _port).start()
+        except OSError as err:
+            # Not fatal for the bot, another on_ready will try again
+            log("Running ping server failed: %r", err)
+            await self.ping_runner.cleanup()
+            self.ping_runner = None
+
+    async def _write_config(self, dirty: asyncio.Event) -> None:
+        # Batches rapid config changes into at most one write a second
+        while True:
+            await dirty.wait()
+            dirty.clear()
+
+            write: asyncio.Future = asyncio.ensure_future(asyncio.to_thread(dump_config))
+
+            try:
+                await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # Finish an ongoing write so it can't race the one main() does on exit
+                await asyncio.wait([write])
+                raise
+            except Exception as err:
+                log("Writing config failed: %r", err)
+
+            await asyncio.sleep(1)
+
+    async def close(self) -> None:
+        if self.config_writer is not None:
+            self.config_writer.cancel()
+
+            try:
+                await self.config_writer
+            except asyncio.CancelledError:
+                pass
+            except Exception as err:
+                log("Config writer failed: %r", err)
+
+            self.config_writer = None
+
+        if self.ping_runner is not None:
+            log("Terminating ping server")
+            await self.ping_runner.cleanup()
+            self.ping_runner = None
+
+        await super().close()
+
     def bot(self, token: Optional[str]) -> None:
         log("Beginning to do checks and run bot")
 
@@ -555,43 +807,74 @@ class Bot(discord.Client):
         self.run(token)
 
     async def on_ready(self) -> None:
-        for guild in self.guilds:
-            for channel in guild.text_channels[::-1]:
-                if (
-                    channel.permissions_for(guild.me).send_messages
-                    and str(channel.type) == "text"
-                ):
-                    self.cchannel = channel
+        self.role_ids.clear()
+
+        # Same pick as before: the first usable channel of the last guild having one
+        for guild in reversed(self.guilds):
+            self.cchannel = next(
+                (
+                    channel
+                    for channel in guild.text_channels
+                    if channel.type == discord.ChannelType.text
+                    and channel.permissions_for(guild.me).send_messages
+                ),
+                None,
+            )
+
+            if self.cchannel is not None:
+                break
 
         if self.cchannel is None:
             async_exit("No text channels I have access to")
             return
 
+        if self.config_writer is None:
+            # Created here so it belongs to the loop discord.py is running
+            self.config_dirty = asyncio.Event()
+            self.config_writer = asyncio.create_task(
+                self._write_config(self.config_dirty)
+            )
+
         log(f"Bot loaded, I am {self.user}")
         await self.parser._send_message(CONFIG["hello-message"])
 
         await self._change_status()
 
+        if self.ping_runner is None:
+            await self._start_ping_server()
+
+    async def on_member_update(
+        self, before: discord.Member, after: discord.Member
+    ) -> None:
+        if after.id == self.user.id:
+            self.role_ids.pop(after.guild.id, None)
+
+    async def on_guild_role_update(
+        self, before: discord.Role, after: discord.Role
+    ) -> None:
+        # Renames can change whether a role counts, see _get_role_ids()
+        self.role_ids.pop(after.guild.id, None)
+
+    async def on_guild_role_delete(self, role: discord.Role) -> None:
+        self.role_ids.pop(role.guild.id, None)
+
     async def on_message(self, message) -> None:
-        if message.author.bot or not any(
-            message.content.startswith(p)
-            for p in (CONFIG["prefix"], CONFIG["note-prefix"])
+        if message.author.bot or not message.content.startswith(
+            GLOBAL_STATE["prefixes"]
         ):
             return
 
         self.cchannel = message.channel
 
         command_str: str = message.content.removeprefix(CONFIG["prefix"])
-        command: List[List[str]] = str_to_command(command_str)
+        command: Command = str_to_command(command_str)
 
         if command_str.startswith(CONFIG["note-prefix"]):
-            note_name: str = command[0][0].removeprefix(CONFIG["note-prefix"])
+            note_name: str = command.words[0].removeprefix(CONFIG["note-prefix"])
 
-            if (
-                note := DB_SESSION.query(Note.content).filter_by(name=note_name).first()
-            ) is not None:
+            if (note := NOTE_CACHE.get(note_name)) is not None:
                 await self.parser._send_message(
-                    "\n".join(f"> {line}" for line in "".join(note).split("\n"))
+                    "\n".join(f"> {line}" for line in note.split("\n"))
                 )
                 return
 
@@ -603,23 +886,18 @@ class Bot(discord.Client):
             return
 
         try:
-            _bot_roles: discord.Member = self.cchannel.guild.get_member(
-                self.user.id
-            ).roles
+            _bot_role_ids: FrozenSet[int] = self._get_role_ids(self.cchannel.guild)
         except AttributeError as e:
-            log(f"Error getting bot roles: {e}")
+            log("Error getting bot roles: %s", e)
             return
 
-        if not any(
-            role in message.author.roles and not role.name[0] == "@"
-            for role in _bot_roles
-        ):
+        if not any(role.id in _bot_role_ids for role in message.author.roles):
             await self.parser._send_message(
                 m("You have no permission to use this bot", message)
             )
             return
 
-        log(f"{message.author} executed {command!r} ({command_str!r})")
+        log("%s executed %r (%r)", message.author, command, command_str)
 
         if not command:
             await self.parser._send_message(
@@ -627,63 +905,44 @@ class Bot(discord.Client):
             )
             return
 
-        if (cmd := get_nth_word(command)) is not None:
-            handler: Optional[Awaitable] = getattr(self.parser, f"cmd_{cmd}", None)
+        # A non-empty command always has a first word
+        cmd: str = get_nth_word(command) or ""
 
-            if handler is None:
-                await self.parser._send_message(
-                    m(
-                        f"Unknown command: {cmd!r}",
-                        message,
-                    )
+        if (entry := COMMANDS.get(cmd)) is None:
+            await self.parser._send_message(
+                m(
+                    f"Unknown command: {cmd!r}",
+                    message,
                 )
-                return
+            )
+            return
 
-            try:
-                await handler(message, command)  # type: ignore
-            except Exception:
-                tb: str = get_traceback_str()
+        try:
+            await entry[0](self.parser, message, command)
+        except Exception:
+            tb: str = get_traceback_str()
 
-                print(tb)
+            print(tb)
 
-                await self.parser._send_message(
-                    m(
-                        f"""
+            await self.parser._send_message(
+                m(
+                    f"""
 Oops! Ran into an error:
 
 ```py
 {tb}
 ```
 """,
-                        message,
-                    )
+                    message,
                 )
-
-            return
-
-        formatted_command: str = pformat_cached(command)
-
-        log(f"Invalid tokens: {formatted_command}")
-
-        _content: str = uncode(
-            f"{command_str!r}\n\n# Turned into:\n\n{formatted_command}", "```"
-        )
-
-        await self.parser._send_message(
-            m(
-                f"""Your command expression did not return any valid tokens
-```py
-{_content}
-```
-""",
-                message,
             )
-        )
 
 
 def main() -> int:
     """Entry/main function"""
 
+    global DB_CONN
+
     if not os.path.exists(CONFIG_PATH):
         log(f"Making new config: {CONFIG_PATH!r}")
         dump_config()
@@ -692,47 +951,36 @@ def main() -> int:
         return 0
 
     print(" || Loading config... ", end="")
-    with open(CONFIG_PATH, "r") as cfg:
-        CONFIG.update(json.load(cfg))
+    with open(CONFIG_PATH, "r", encoding="utf-8") as cfg:
+        CONFIG.update(json_loads(cfg.read()))
+    GLOBAL_STATE["prefixes"] = (CONFIG["prefix"], CONFIG["note-prefix"])
     print("done")
 
-    # Ping server
-    log("Setting up the ping server")
-    _ping_app: Flask = Flask("")
-
     logging.basicConfig(level=logging.CRITICAL)
-    logging.getLogger("werkzeug").disabled = True
-    _ping_app.logger.disabled = True
-
-    @_ping_app.route("/")
-    def _ping():
-        return ""
-
-    def _ping_app_run():
-        try:
-            _port: int = semi_random_int(2000, 9000)
-            log(f"Running ping server at port {_port!r}")
-            _ping_app.run(host="0.0.0.0", port=_port)
-        except KeyboardInterrupt:
-            pass
-
-    log("Running the ping server")
-    ping_p: Process = Process(target=_ping_app_run)
-    ping_p.start()
-    # ---
 
     if not sqlalchemy_utils.database_exists(DB_ENGINE.url):
         log(f"Creating database: {DB_ENGINE.url!r}")
         DB_BASE.metadata.create_all(DB_ENGINE)
 
+    DB_CONN = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    set_db_pragmas(DB_CONN)
+    load_notes()
+
+    psutil.cpu_percent(percpu=True)  # Seed CPU usage for botfetch
+
+    try:
+        import uvloop  # type: ignore
+
+        log("Using uvloop")
+        uvloop.install()
+    except ImportError:
+        pass
+
     try:
         Bot().bot(os.environ.get("GI_TOKEN"))
     except Exception:
         print(get_traceback_str())
     finally:
-        log("Terminating ping server")
-        ping_p.terminate()
-
         dump_config()
 
         log(f"Exiting with code {GLOBAL_STATE['exit']!r}")